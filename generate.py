@@ -1,60 +1,88 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
+import json
+import re
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from time import time
 from urllib.parse import quote
-from os import path as pathlib, remove
-from string import Template
+from os import path as pathlib, makedirs
 
-query_template = Template('''
+query_template = '''
 #defaultView:MapRegions
 # version 8
 SELECT
   (if(bound(?id2),?id2,?id) as ?id)
-  $outputVars
+  {outputVars}
 WHERE {
 # Using nested query to ensure there is only one ?id2 value
 {SELECT
   ?id
   (SAMPLE(?id2) as ?id2)
-$outputs
+{outputs}
 WHERE {
   # List of regions, whose sub-regions we want.
-  VALUES ?entity { $entities }
+  VALUES ?entity { {entities} }
 
   # P150 = "contains administrative territorial entity"
-  ?entity $depth ?id .
+  ?entity {depth} ?id .
 
-$use_id2
-$condition
-$labels
-$fields
+{use_id2}
+{condition}
+{labels}
+{fields}
 }
 # remove possible ID duplicates
-GROUP BY ?id}
+GROUP BY ?id{group_extra}}
 }
-''')
+'''
 
-label_query_template = Template('  OPTIONAL { ?id rdfs:label ?label_$lang . FILTER(LANG(?label_$lang) = "$lang") }')
-field_query_template = Template('  OPTIONAL { ?id wdt:$prop ?$var }')
-var_out_template = Template('  (SAMPLE(?$var) as ?$var)')
-condition_template = Template('  FILTER($cond)')
+# The scaffolding around the slots above is constant, so split it once
+# at import; sparql() then renders a query with a single ''.join instead
+# of scanning the whole template through a format/Template parser each
+# call. Odd positions in _query_parts are the slot names.
+_query_parts = re.split(
+  r'\{(outputVars|outputs|entities|depth|use_id2|condition|labels|fields|group_extra)\}',
+  query_template)
+
+# Plain format strings for the per-item fragments (literal braces
+# doubled) - str.format is faster than string.Template, which re-parses
+# its pattern on every substitute()
+label_query_template = '  OPTIONAL {{ ?id rdfs:label ?label_{lang} . FILTER(LANG(?label_{lang}) = "{lang}") }}'
+field_query_template = '  OPTIONAL {{ ?id wdt:{prop} ?{var} }}'
+var_out_template = '  (SAMPLE(?{var}) as ?{var})'
+condition_template = '  FILTER({cond})'
+
+# Resolved once - realpath stats the filesystem, and filepath is called
+# for every saved file
+_BASE = pathlib.dirname(pathlib.realpath(__file__))
 
 def filepath(*values):
-  return pathlib.join(pathlib.dirname(pathlib.realpath(__file__)), *values)
+  return pathlib.join(_BASE, *values)
 
 
-def sparql(entities, labels, fields, depth=1, condition=False, use_coextensive=False):
+@lru_cache(maxsize=64)
+def sparql(entities, labels, fields, depth=1, condition=False, use_coextensive=False,
+           group_by_entity=False):
   '''
-  entities: list|string, each value as a Qnnn: 'Q16'
-  labels: list of lang codes
-  fields: dict, e.g. {'iso_3166_2': 'P300', ...}
+  entities: tuple|string, each value as a Qnnn: 'Q16'
+  labels: tuple of lang codes
+  fields: tuple of (field_name, property) pairs, e.g. (('iso_3166_2', 'P300'),)
   depth: how many levels of P150 to use. 1 - immediate, 2 - two levels down,...
   condition: any additional SPARQL condition
+  group_by_entity: also project ?entity, so that a multi-entity result
+    can be split into per-entity files client-side
+
+  All arguments are hashable so repeated calls hit the lru_cache.
   '''
 
-  if type(entities) == type(''): entities = [entities]
+  if isinstance(entities, str): entities = (entities,)
 
-  outputVars = list(fields.keys()) + ['label_' + v for v in labels]
+  outputVars = [*(k for k, _ in fields), *('label_' + v for v in labels)]
 
   if use_coextensive:
     # There are some combined city-counties, like New York boroughs.
@@ -68,72 +96,269 @@ def sparql(entities, labels, fields, depth=1, condition=False, use_coextensive=F
   else:
     use_id2 = ''
 
-  return query_template.substitute(
-    entities=' '.join(['wd:' + e for e in entities]),
-    depth='/'.join(['wdt:P150' for i in range(depth)]),
-    labels='\n'.join([label_query_template.substitute({'lang': l}) for l in labels]),
-    fields='\n'.join([field_query_template.substitute({'var': k, 'prop': v}) for k,v in fields.items()]),
-    outputs='\n'.join([var_out_template.substitute({'var': v}) for v in outputVars]),
-    outputVars=' '.join(['?' + v for v in outputVars]),
-    condition='' if not condition else condition_template.substitute({'cond': condition}),
-    use_id2=use_id2,
-  )
-
-def run_query(filetype, name, query):
-  url = 'https://sophox.org/regions/{0}.json?sparql={1}'.format(filetype, quote(query))
-
-  response = requests.get(url)
+  # Single-pass joins over generators - no intermediate list per section
+  outputs = '\n'.join(var_out_template.format(var=v) for v in outputVars) if outputVars else ''
+  outputVarsStr = ' '.join('?' + v for v in outputVars)
+  if group_by_entity:
+    # ?entity is part of the inner GROUP BY, so it is projected as is,
+    # without the SAMPLE() used for the other outputs.
+    outputs += '\n  ?entity'
+    outputVarsStr += ' ?entity'
+
+  values = {
+    'entities': ' '.join('wd:' + e for e in entities),
+    'depth': '/'.join(['wdt:P150'] * depth),
+    # Empty sections become a literal '' without spinning up a generator
+    'labels': '\n'.join(label_query_template.format(lang=l) for l in labels) if labels else '',
+    'fields': '\n'.join(field_query_template.format(var=k, prop=v) for k,v in fields) if fields else '',
+    'outputs': outputs,
+    'outputVars': outputVarsStr,
+    'condition': '' if not condition else condition_template.format(cond=condition),
+    'use_id2': use_id2,
+    'group_extra': ' ?entity' if group_by_entity else '',
+  }
+  return ''.join(values[part] if i % 2 else part
+                 for i, part in enumerate(_query_parts))
+
+# Cached sophox responses are reused for this long, making development
+# reruns free; pass --no-cache to always query sophox
+CACHE_MAX_AGE = 7 * 24 * 3600
+
+def run_query(session, filetype, query, use_cache=True):
+  # Responses are cached by query text, so an unchanged query is served
+  # from disk instead of re-evaluated by sophox
+  key = hashlib.sha1((filetype + '\0' + query).encode('utf-8')).hexdigest()
+  cache_path = filepath('.cache', '{0}.{1}'.format(key, filetype))
+  if use_cache and pathlib.exists(cache_path) and time() - pathlib.getmtime(cache_path) < CACHE_MAX_AGE:
+    with open(cache_path, 'rb') as file:
+      return file.read()
+
+  url = 'https://sophox.org/regions/{0}.json'.format(filetype)
+  headers = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, deflate',
+  }
+
+  # POST the query as the raw body - skips percent-encoding the multi-KB
+  # query (~3x expansion) and stays clear of URL length limits
+  response = session.post(url, data=query.encode('utf-8'), stream=True,
+                          headers=dict(headers, **{'Content-Type': 'application/sparql-query'}))
+  if not response.ok:
+    # The regions endpoint is a custom ?sparql= frontend, so it may
+    # reject the POST with any status - retry via the known-good
+    # encoded GET before giving up
+    response = session.get('{0}?sparql={1}'.format(url, quote(query)),
+                           stream=True, headers=headers)
   response.raise_for_status()
+  # Consume the body in chunks - decompression overlaps the download and
+  # no intermediate str is materialized (us_counties is multi-MB)
+  data = b''.join(response.iter_content(65536))
+
+  makedirs(filepath('.cache'), exist_ok=True)
+  with open(cache_path, 'wb') as file:
+    file.write(data)
+  return data
 
+def save_geo(filetype, name, data):
   path = filepath(filetype, name + '.' + filetype)
-  with open(path, 'w', encoding='utf-8') as file:
-    file.write(response.text)
+  with open(path, 'wb') as file:
+    file.write(data)
+
+  print('Saved {0} {1:,}B => {2}'.format(name, len(data), path))
+
+def write_queries_md(entries):
+  # Document the queries we used, in one open/write/close
+  with open(filepath('QUERIES.md'), 'w', encoding='utf-8') as file:
+    file.write('# Auto-generated list of queries\n\n')
+    for name, query in entries:
+      file.write('* [{0}](https://sophox.org/sophox/#{1})\n'.format(name, quote(query)))
+
+def geo_dumps(value):
+  # Match the compact formatting sophox uses for its responses;
+  # UTF-8 bytes, ready for the binary-mode save_geo
+  return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decode_arcs(topo):
+  # Arcs are delta-encoded only when the topology is quantized.
+  # Sophox currently returns absolute coordinates (no 'transform').
+  transform = topo.get('transform')
+  if not transform:
+    return topo['arcs']
+  scale_x, scale_y = transform['scale']
+  translate_x, translate_y = transform['translate']
+  arcs = []
+  for arc in topo['arcs']:
+    x = y = 0
+    points = []
+    for dx, dy in arc:
+      x += dx
+      y += dy
+      points.append([x * scale_x + translate_x, y * scale_y + translate_y])
+    arcs.append(points)
+  return arcs
 
-  print('Downloaded {0} {1:,}B => {2}'.format(name, len(response.text), path))
+def stitch_arcs(arc_indexes, arcs):
+  # Per topojson spec, a negative index ~i means arc i reversed, and
+  # consecutive arcs share their join point.
+  points = []
+  for index in arc_indexes:
+    arc = arcs[index] if index >= 0 else arcs[~index][::-1]
+    points.extend(arc[1:] if points else arc)
+  return points
 
-def append_queries_md(text):
-  # Document the query we used
-  with open(filepath('QUERIES.md'), 'a', encoding='utf-8') as file:
-    file.write(text)
+def topo_geometry(geometry, arcs):
+  if geometry['type'] == 'Polygon':
+    coordinates = [stitch_arcs(ring, arcs) for ring in geometry['arcs']]
+  elif geometry['type'] == 'MultiPolygon':
+    coordinates = [[stitch_arcs(ring, arcs) for ring in polygon]
+                   for polygon in geometry['arcs']]
+  else:
+    raise ValueError('Unexpected topojson geometry ' + geometry['type'])
+  return {'type': geometry['type'], 'coordinates': coordinates}
+
+def topo_to_geojson(topo):
+  # Both sophox converters post-process the same SPARQL result, so the
+  # geojson can be reconstructed locally from the topojson response.
+  arcs = decode_arcs(topo)
+  features = [{'type': 'Feature',
+               'id': geometry['id'],
+               'properties': geometry['properties'],
+               'geometry': topo_geometry(geometry, arcs)}
+              for geometry in topo['objects']['data']['geometries']]
+  return {'type': 'FeatureCollection', 'features': features}
+
+def remap_arcs(arc_indexes, arc_map, old_arcs, new_arcs):
+  # Rewrite (possibly nested) arc index lists against a new arcs array
+  # that holds only the arcs this geometry subset actually references.
+  result = []
+  for index in arc_indexes:
+    if isinstance(index, list):
+      result.append(remap_arcs(index, arc_map, old_arcs, new_arcs))
+      continue
+    old = index if index >= 0 else ~index
+    if old not in arc_map:
+      arc_map[old] = len(new_arcs)
+      new_arcs.append(old_arcs[old])
+    new = arc_map[old]
+    result.append(new if index >= 0 else ~new)
+  return result
+
+def partition_topo(topo, entity, keep_vars):
+  '''
+  Extract one entity's regions from a batched (group_by_entity) topojson
+  response, keeping only the properties in keep_vars.
+  '''
+  old_arcs = topo['arcs']
+  arc_map = {}
+  new_arcs = []
+  geometries = []
+  for geometry in topo['objects']['data']['geometries']:
+    # sophox may return ?entity as a full URI or a bare Q-ID
+    if geometry['properties'].get('entity', '').rsplit('/', 1)[-1] != entity:
+      continue
+    geometries.append({
+      'type': geometry['type'],
+      'arcs': remap_arcs(geometry['arcs'], arc_map, old_arcs, new_arcs),
+      'id': geometry['id'],
+      'properties': {k: v for k, v in geometry['properties'].items() if k in keep_vars},
+    })
+
+  if not geometries:
+    raise ValueError(
+      'No regions for entity {0} in the batched response - wrong Q-ID, '
+      'a data gap, or sophox changed how ?entity is reported'.format(entity))
 
-def gen(name, query):
-  append_queries_md('* [{}](https://sophox.org/sophox/#{})\n'.format(name, quote(query)))
-  run_query('topojson', name, query)
-  run_query('geojson', name, query)
+  # Quantized arcs are delta-encoded within each arc, so the subset can
+  # be copied verbatim as long as the transform is carried along too;
+  # the bbox however must come from the decoded coordinates.
+  transform = topo.get('transform')
+  points = [point for arc in decode_arcs({'arcs': new_arcs, 'transform': transform})
+            for point in arc]
+  bbox = [min(p[0] for p in points), min(p[1] for p in points),
+          max(p[0] for p in points), max(p[1] for p in points)]
+  result = {'type': 'Topology', 'bbox': bbox,
+            'objects': {'data': {'type': 'GeometryCollection', 'geometries': geometries}},
+            'arcs': new_arcs}
+  if transform:
+    result['transform'] = transform
+  return result
 
+def gen(session, name, query, use_cache=True):
+  data = run_query(session, 'topojson', query, use_cache)
+  save_geo('topojson', name, data)
+  save_geo('geojson', name, geo_dumps(topo_to_geojson(json.loads(data))))
+
+def gen_batch(session, countries, fields, query, use_cache=True):
+  topo = json.loads(run_query(session, 'topojson', query, use_cache))
+  for name, entity, labels in countries:
+    keep_vars = {var for var, _ in fields} | {'label_' + l for l in labels}
+    country_topo = partition_topo(topo, entity, keep_vars)
+    save_geo('topojson', name, geo_dumps(country_topo))
+    save_geo('geojson', name, geo_dumps(topo_to_geojson(country_topo)))
 
 if __name__ == "__main__":
-  try:
-    remove(filepath('QUERIES.md'))
-  except:
-    raise
-  append_queries_md('# Auto-generated list of queries\n\n')
+  parser = argparse.ArgumentParser(description='Regenerate the region files from sophox.org')
+  parser.add_argument('--no-cache', action='store_true',
+                      help='always query sophox, ignoring cached responses in .cache/')
+  args = parser.parse_args()
+  use_cache = not args.no_cache
 
   # sparql params:
-  # <region Wikidata ID (str or list)>,
+  # <region Wikidata ID (str or tuple)>,
   # <depth level - 1 for immediate sub-regions, e.g. states for US, 2 - counties>
-  # <list of label language codes>,
-  # <dict of additional IDs:  <field_name>: <wikidata property ID>>
-
-  gen('canada', sparql('Q16', ['en','fr'], {'iso_3166_2':'P300'}))
-  gen('germany', sparql('Q183', ['en','de'], {'iso_3166_2':'P300'}))
-  gen('china', sparql('Q148', ['en','zh'], {'iso_3166_2':'P300'}))
-  gen('united_kingdom', sparql('Q145', ['en'], {'iso_3166_2':'P300'}))
-  gen('france', sparql('Q142', ['en', 'fr'], {'iso_3166_2':'P300'}))
-  gen('spain', sparql('Q29', ['en', 'es'], {'iso_3166_2':'P300'}))
-  gen('russia', sparql('Q159', ['en', 'ru'], {'iso_3166_2':'P300'}))
-  gen('india', sparql('Q668', ['en'], {'iso_3166_2':'P300'}))
-  gen('japan', sparql('Q17', ['en', 'ja'], {'iso_3166_2':'P300'}))
-  gen('australia', sparql('Q408', ['en'], {'iso_3166_2':'P300'}))
-  gen('netherland', sparql('Q55', ['en', 'nl'], {'iso_3166_2':'P300'}))
-  gen('south korea', sparql('Q884', ['en', 'ko'], {'iso_3166_2':'P300'}))
-  gen('brazil', sparql('Q155', ['en', 'pt'], {'iso_3166_2':'P300'}))
-  gen('sweden', sparql('Q34', ['en', 'sv'], {'iso_3166_2':'P300'}))
-  gen('poland', sparql('Q36', ['en', 'pl'], {'iso_3166_2':'P300'}))
-  gen('turkey', sparql('Q43', ['en', 'tr'], {'iso_3166_2':'P300'}))
-  
-  gen('us_states', sparql('Q30', ['en'], {'iso_3166_2':'P300', 'fips_5_2_alpha':'P5086'}))
-
-  gen('us_counties', sparql('Q30', ['en'],
-        {'fips_6_4_alpha': 'P882', 'gnis': 'P590', 'viaf': 'P214'},
-        depth=2, use_coextensive=True))
+  # <tuple of label language codes>,
+  # <tuple of additional ID pairs:  (<field_name>, <wikidata property ID>)>
+
+  # These countries all share the same query shape (depth=1, iso_3166_2),
+  # so they are fetched with a single batched query and split per entity
+  # client-side.
+  batched_countries = [
+    ('canada', 'Q16', ('en','fr')),
+    ('germany', 'Q183', ('en','de')),
+    ('china', 'Q148', ('en','zh')),
+    ('united_kingdom', 'Q145', ('en',)),
+    ('france', 'Q142', ('en', 'fr')),
+    ('spain', 'Q29', ('en', 'es')),
+    ('russia', 'Q159', ('en', 'ru')),
+    ('india', 'Q668', ('en',)),
+    ('japan', 'Q17', ('en', 'ja')),
+    ('australia', 'Q408', ('en',)),
+    ('netherland', 'Q55', ('en', 'nl')),
+    ('south korea', 'Q884', ('en', 'ko')),
+    ('brazil', 'Q155', ('en', 'pt')),
+    ('sweden', 'Q34', ('en', 'sv')),
+    ('poland', 'Q36', ('en', 'pl')),
+    ('turkey', 'Q43', ('en', 'tr')),
+  ]
+  batched_fields = (('iso_3166_2', 'P300'),)
+  batch_query = sparql(tuple(entity for _, entity, _ in batched_countries),
+                       tuple(sorted({l for _, _, labels in batched_countries for l in labels})),
+                       batched_fields, group_by_entity=True)
+
+  queries = [
+    ('us_states', sparql('Q30', ('en',), (('iso_3166_2', 'P300'), ('fips_5_2_alpha', 'P5086')))),
+
+    ('us_counties', sparql('Q30', ('en',),
+          (('fips_6_4_alpha', 'P882'), ('gnis', 'P590'), ('viaf', 'P214')),
+          depth=2, use_coextensive=True)),
+  ]
+
+  # Document all queries up front so QUERIES.md order does not depend
+  # on download completion order.
+  write_queries_md([('batched countries', batch_query)] + queries)
+
+  # Sophox answers each query independently, so fetch them concurrently
+  # over a single keep-alive session instead of paying a fresh TCP/TLS
+  # round-trip per country.
+  session = requests.Session()
+  session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+  # Submit every query up front so sophox works on all of them at once;
+  # max_workers bounds the concurrency to stay within fair use.
+  with ThreadPoolExecutor(max_workers=8) as executor:
+    futures = [executor.submit(gen_batch, session, batched_countries, batched_fields,
+                               batch_query, use_cache)]
+    futures += [executor.submit(gen, session, name, query, use_cache) for name, query in queries]
+    for future in futures:
+      future.result()